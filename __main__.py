@@ -1,8 +1,11 @@
 import pygame
+import time
 from vm import Runtime
 
 
 WINDOW_SIZE = (640, 480)
+FRAMERATE = 60
+FRAME_MS = 1000 // FRAMERATE
 
 class GraphicalDemo:
 
@@ -20,13 +23,21 @@ class GraphicalDemo:
 
         self.running = False
 
-    def poll_events(self):
+    def poll_events(self, timeout: int):
+        """Sleep until an event arrives or the timeout (in ms) runs out,
+        then handle everything in the queue."""
+        # A zero timeout would make wait() block indefinitely.
+        if timeout > 0:
+            self.handle_event(pygame.event.wait(timeout))
         for event in pygame.event.get():
-            if event.type == pygame.QUIT:
+            self.handle_event(event)
+
+    def handle_event(self, event):
+        if event.type == pygame.QUIT:
+            self.stop()
+        elif event.type in (pygame.KEYDOWN, pygame.KEYUP):
+            if event.key == pygame.K_ESCAPE:
                 self.stop()
-            elif event.type in (pygame.KEYDOWN, pygame.KEYUP):
-                if event.key == pygame.K_ESCAPE:
-                    self.stop()
 
     def run(self):
         self.running = True
@@ -35,10 +46,13 @@ class GraphicalDemo:
 
     def loop(self):
         while self.running:
-            self.poll_events()
+            frame_start = time.perf_counter()
+            self.runtime.tick()
             self.runtime.draw()
-            delta = self.clock.tick(60)
             pygame.display.flip()
+            budget = max(0, FRAME_MS - int((time.perf_counter() - frame_start) * 1000))
+            self.poll_events(budget)
+            delta = self.clock.tick(FRAMERATE)
         pygame.quit()
 
     def stop(self):
@@ -28,9 +28,20 @@ for opval, opfunc in VMThread.opcodes.items():
         opcodes[name] = []
     opcodes[name].append((opval, opfunc))
 
+
+def tokenize(line):
+    tokens = shlex.split(line, comments=True)
+
+    # Strip semicolon comments
+    try:
+        tokens = tokens[:tokens.index(';')]
+    except ValueError:
+        pass
+    return tokens
+
+
 if args.verbose == 1: print(f"opening {args.input}")
 with open(args.input[0]) as file:
-    output = bytearray()
     lines = file.readlines()
 
     # Scan for procedure labels
@@ -40,27 +51,27 @@ with open(args.input[0]) as file:
     if args.verbose >= 1:
         print(f"assembling {len(lines)} lines")
 
+    tokenized = [tokenize(line) for line in lines]
+
+    # Preallocate for the worst case: an opcode byte per line, and for each
+    # operand either an integer or a terminated string. Trimmed at the end.
+    output = bytearray(sum(1 + sum(max(4, len(token.encode("utf-8")) + 1) for token in tokens[1:])
+                           for tokens in tokenized))
+    cursor = 0
+
     # Scan for opcodes
-    for line_no, line in enumerate(lines):
+    for line_no, tokens in enumerate(tokenized):
         if args.verbose >= 2:
-            print(f"{line_no}/{len(output)}: {line.strip()}")
-        line.strip()
-        tokens = list(shlex.split(line, comments=True))
-
-        # Strip semicolon comments
-        try:
-            tokens = tokens[:tokens.index(';')]
-        except ValueError:
-            pass
+            print(f"{line_no}/{cursor}: {lines[line_no].strip()}")
 
         if len(tokens) > 0:
             # Procedure label
             if len(tokens) == 1 and tokens[0][-1] == ':':
                 procedure_name = tokens[0][:-1]
                 if args.verbose >= 2:
-                    print(f"{line_no}: procedure {procedure_name} @ {len(output)}")
+                    print(f"{line_no}: procedure {procedure_name} @ {cursor}")
                 if procedure_name not in procedures:
-                    procedures[procedure_name] = len(output)
+                    procedures[procedure_name] = cursor
                 else:
                     raise AssemblyError(line_no, f"duplicate procedure {procedure_name}")
                 continue
@@ -76,10 +87,12 @@ with open(args.input[0]) as file:
                 if args.verbose >= 2:
                     print(f"{line_no}: interpreting as {interpretation[1].__name__}")
 
-                buffer = bytearray()
+                # Where to roll back to if this interpretation fails
+                start, refs_start = cursor, len(procedure_refs)
 
                 # Write the operation
-                buffer.append(interpretation[0])
+                output[cursor] = interpretation[0]
+                cursor += 1
 
                 try:
                     operands = interpretation[1].operands
@@ -87,37 +100,38 @@ with open(args.input[0]) as file:
                         if operand_type == vm.LITINT:
                             try:
                                 token_int = int(token)
-                                buffer.extend(struct.pack("i", token_int))
+                                struct.pack_into("<i", output, cursor, token_int)
                             except ValueError:
                                 if token[0] == '@':
-                                    procedure_refs.append((len(output) + len(buffer), token[1:]))
-                                    buffer.extend(struct.pack("I", 0))
+                                    procedure_refs.append((cursor, token[1:]))
                                 else:
                                     raise AssemblyError(line_no, f"{token} is not a number or procedure")
+                            cursor += 4
                         elif operand_type == vm.LITSTR:
-                            buffer.extend(token.encode("utf-8"))
-                            buffer.append(0)
+                            encoded = token.encode("utf-8")
+                            output[cursor:cursor + len(encoded)] = encoded
+                            cursor += len(encoded)
+                            output[cursor] = 0
+                            cursor += 1
                     # Break if there is no error
-                    output.extend(buffer)
                     error = None
                     break
                 except AssemblyError as e:
                     error = e
+                    cursor = start
+                    del procedure_refs[refs_start:]
             if error:
                 raise error
 
+    del output[cursor:]
+
     if args.verbose >= 1:
         print("committing procedure table")
 
     # Replace the procedure references with the actual addresses
-    for procedure_ref in procedure_refs:
-        location, name = procedure_ref
+    for location, name in procedure_refs:
         if name in procedures:
-            # Sorry, we're going to have to mutate the output
-            # to get the integer in
-            output = output[:location]\
-                     + struct.pack("I", procedures[name])\
-                     + output[location+4:]
+            struct.pack_into("<I", output, location, procedures[name])
         else:
             raise AssemblyError(0, f"procedure {name} not found")
 
@@ -1,6 +1,21 @@
-import pygame, re
+import pygame
 
 
+# Images already loaded from disk, keyed by path. Shared between sprites,
+# so they must not be drawn on directly.
+_image_cache = dict()
+
+
+def _load(path: str) -> pygame.Surface:
+    """Load an image, reusing a previously loaded copy if there is one.
+    The display mode must already be set, since the image is converted
+    to the display's pixel format for faster blitting."""
+    surface = _image_cache.get(path)
+    if surface is None:
+        surface = pygame.image.load(path).convert_alpha()
+        _image_cache[path] = surface
+    return surface
+
 
 class SpriteSurface(pygame.sprite.Sprite):
 
@@ -8,14 +23,20 @@ class SpriteSurface(pygame.sprite.Sprite):
         super().__init__()
         self._images = dict()
         with open(path) as file:
-            for image in re.finditer("^(.+)=(.+)$", file.read(), re.MULTILINE):
+            for line in file:
+                line = line.strip()
+                if not line or '=' not in line:
+                    continue
+                name, image_path = line.split('=', 1)
                 try:
-                    self._images[image[1]] = pygame.image.load(image[2])
+                    self._images[name] = _load(image_path)
                 except IOError:
-                    print("Couldn't load image {0} at path {1}.".format(image[0], image[1]))
+                    print("Couldn't load image {0} at path {1}.".format(name, image_path))
         self._anim_name = "default"
         self._alpha = 255
+        self._mask = None
         self.image = self._images[self._anim_name]
+        self.image_alpha = self.image
         self.rect = self.image.get_rect()
 
     @property
@@ -26,6 +47,8 @@ class SpriteSurface(pygame.sprite.Sprite):
     def alpha(self, alpha):
         if not 0 <= alpha <= 255:
             raise ValueError("Alpha must be within bounds")
+        if alpha == self._alpha:
+            return
         self._alpha = alpha
         self.draw_alpha()
 
@@ -33,10 +56,16 @@ class SpriteSurface(pygame.sprite.Sprite):
         if self.alpha == 255:
             self.image_alpha = self.image
         else:
-            mask = pygame.Surface(self.image.get_size(), flags=pygame.SRCALPHA)
-            mask.fill((255, 255, 255, self.alpha))
-            self.image_alpha = self.image.copy()
-            self.image_alpha.blit(mask, (0, 0), special_flags=pygame.BLEND_RGBA_MULT)
+            # Images come from _load, so they always have per-pixel alpha.
+            # Reuse one scratch surface as long as the image size stays the same.
+            size = self.image.get_size()
+            if self._mask is None or self._mask.get_size() != size:
+                self._mask = pygame.Surface(size, flags=pygame.SRCALPHA).convert_alpha()
+            # Multiplying the image into the filled mask gives the same
+            # result as multiplying the mask into a copy of the image.
+            self._mask.fill((255, 255, 255, self.alpha))
+            self._mask.blit(self.image, (0, 0), special_flags=pygame.BLEND_RGBA_MULT)
+            self.image_alpha = self._mask
 
     @property
     def anim_name(self):
@@ -45,4 +74,5 @@ class SpriteSurface(pygame.sprite.Sprite):
     @anim_name.setter
     def anim_name(self, name):
         self.image = self._images[name]
-        self._anim_name = name
\ No newline at end of file
+        self._anim_name = name
+        self.draw_alpha()
\ No newline at end of file
@@ -0,0 +1,147 @@
+import hashlib
+import os
+import pickle
+import subprocess
+import sys
+
+import pytest
+
+pygame = pytest.importorskip("pygame")
+
+import vm
+
+CODEGEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "codegen.py")
+
+
+@pytest.fixture(autouse=True)
+def program_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(vm, "PROGRAM_CACHE_DIR", str(tmp_path / "cache"))
+
+
+def assemble(tmp_path, source: str) -> bytes:
+    asm = tmp_path / "test.vnasm"
+    out = tmp_path / "test.out"
+    asm.write_text(source)
+    subprocess.run([sys.executable, CODEGEN, str(asm), str(out)], check=True)
+    return out.read_bytes()
+
+
+def run(tmp_path, source: str):
+    """Run a program to completion, returning the runtime and its main thread."""
+    runtime = vm.Runtime(None, assemble(tmp_path, source))
+    runtime.start()
+    thread = runtime.threads[0]
+    while runtime.threads:
+        runtime.tick()
+    return runtime, thread
+
+
+def test_castis_pushes_onto_string_stack(tmp_path, capsys):
+    _, thread = run(tmp_path, 'pushi 42\ncast\npushs "x"\nconcat\ndbgs\nreset\n')
+    assert thread.str_stack[:thread.ssp] == ["42x"]
+    assert capsys.readouterr().out == "42x\n"
+
+
+def test_negative_literals_round_trip(tmp_path, capsys):
+    run(tmp_path, 'pushi -1\ndbgi\njl @neg\npushs "pos"\ndbgs\nreset\n'
+                  'neg:\npushs "neg"\ndbgs\nreset\n')
+    assert capsys.readouterr().out.split() == ["-1", "neg"]
+
+
+@pytest.mark.parametrize("source", [
+    "add\ndbgi\nreset\n",
+    "pushi 5\nadd\npushi 1\ndbgi\nreset\n",
+    'pushs "x"\nconcat\ndbgs\nreset\n',
+])
+def test_stack_underflow_core_dumps(tmp_path, capsys, source):
+    _, thread = run(tmp_path, source)
+    captured = capsys.readouterr()
+    assert not thread.running
+    assert captured.out.startswith("Core dumped!")
+    assert "stack underflow" in captured.err
+
+
+@pytest.fixture
+def display(monkeypatch):
+    """A headless display, so sprites can be loaded relative to the repo."""
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    monkeypatch.chdir(os.path.dirname(CODEGEN))
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+    yield
+    pygame.display.quit()
+
+
+def test_underflow_is_caught_before_side_effects(tmp_path, display):
+    runtime, _ = run(tmp_path, 'pushs "sprites/stick.ini"\nloadspr\nreset\n')
+    assert runtime.sprite_bank == [None] * vm.MAX_BANKS
+    assert list(runtime.free_banks) == list(range(vm.MAX_BANKS))
+
+
+@pytest.mark.parametrize("source", [
+    "pushi 5\n",
+    "jmp @end\nend:\n",
+])
+def test_running_off_the_end_core_dumps(tmp_path, capsys, source):
+    runtime, thread = run(tmp_path, source)
+    assert not thread.running
+    assert runtime.threads == []
+    assert capsys.readouterr().out.startswith("Core dumped!")
+
+
+def test_unloading_empty_bank_keeps_free_banks(tmp_path):
+    runtime, _ = run(tmp_path, "pushi 0\nunloadspr\nreset\n")
+    assert list(runtime.free_banks) == list(range(vm.MAX_BANKS))
+
+
+def cache_file(code: bytes) -> str:
+    return vm.Runtime._program_cache_path(hashlib.sha256(vm.VMThread._signature + code).hexdigest())
+
+
+def forbid_decoding(monkeypatch):
+    def fail(self):
+        raise AssertionError("program was decoded instead of loaded from cache")
+    monkeypatch.setattr(vm.Runtime, "_decode_bytecode", fail)
+
+
+def test_program_cache_round_trip(tmp_path, monkeypatch):
+    code = assemble(tmp_path, "pushi 7\ndbgi\nreset\n")
+    decoded = vm.Runtime(None, code).program
+    assert os.path.isfile(cache_file(code))
+    forbid_decoding(monkeypatch)
+    assert vm.Runtime(None, code).program == decoded
+
+
+def test_program_cache_replays_warnings(tmp_path, capsys):
+    code = b"\x99" + assemble(tmp_path, "reset\n")
+    vm.Runtime(None, code)
+    vm.Runtime(None, code)
+    assert capsys.readouterr().out == "Opcode 153 not found\n" * 2
+
+
+@pytest.mark.parametrize("entry", [
+    b"not a pickle",
+    pickle.dumps(5),
+    pickle.dumps((vm.PROGRAM_CACHE_VERSION - 1, [], {}, [])),
+    pickle.dumps((vm.PROGRAM_CACHE_VERSION, [(0x99, ())], {0: 0}, [])),
+])
+def test_bad_program_cache_falls_back_to_decoding(tmp_path, monkeypatch, entry):
+    code = assemble(tmp_path, "pushi 7\ndbgi\nreset\n")
+    decoded = vm.Runtime(None, code).program
+    with open(cache_file(code), "wb") as file:
+        file.write(entry)
+    assert vm.Runtime(None, code).program == decoded
+    # The bad entry was replaced with a good one.
+    forbid_decoding(monkeypatch)
+    assert vm.Runtime(None, code).program == decoded
+
+
+def test_truncated_integer_operand_is_rejected(tmp_path):
+    code = assemble(tmp_path, "pushi 7\n")
+    with pytest.raises(ValueError, match="truncated integer operand"):
+        vm.Runtime(None, code[:-1])
+
+
+def test_jumps_resolve_to_instructions(tmp_path, capsys):
+    run(tmp_path, "pushi 3\nloop:\ndbgi\npushi 1\nsub\ndupi\njg @loop\nreset\n")
+    assert capsys.readouterr().out.split() == ["3", "2", "1"]
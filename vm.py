@@ -1,20 +1,49 @@
 import pygame
-import threading
-import struct
-from time import sleep
+import hashlib
+import os
+import pickle
+import tempfile
+import traceback
+from array import array
+from collections import deque
+from functools import lru_cache
+from time import perf_counter
 from spritesurface import SpriteSurface
 
 MAX_BANKS = 32
+# Number of instructions each thread may run per tick.
+QUANTUM = 1000
+INT_STACK_SIZE = 1024
+STR_STACK_SIZE = 256
 
 LITINT = 0
 LITSTR = 1
 
+# Bump whenever the decoded program format changes.
+PROGRAM_CACHE_VERSION = 3
+PROGRAM_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "vnvm")
+
+
+# Dialogue tends to build the same strings over and over,
+# so the pure string ops are memoized.
+@lru_cache(maxsize=1024)
+def _concat(a: str, b: str) -> str:
+    return a + b
+
+
+@lru_cache(maxsize=1024)
+def _cast(i: int) -> str:
+    return str(i)
+
 
 class Runtime:
     def __init__(self, window: pygame.Surface, code: bytes):
         self.window = window
         self.code = code
+        self._decode()
         self.sprite_bank = [None] * MAX_BANKS
+        # Empty sprite banks; openbank hands out the one at the front.
+        self.free_banks = deque(range(MAX_BANKS))
         self.sprites = pygame.sprite.LayeredUpdates()
         self.threads = []
 
@@ -22,17 +51,122 @@ class Runtime:
         """Start the VM."""
         if len(self.threads) > 0:
             raise RuntimeError("Runtime is already running")
-        thread = VMThread(self)
-        thread.start()
-        self.threads.append(thread)
+        self.threads.append(VMThread(self))
+
+    def tick(self):
+        """Run every thread for one time slice."""
+        # Threads may fork or reset the runtime while running.
+        for thread in list(self.threads):
+            if thread.running:
+                try:
+                    thread.run()
+                except Exception:
+                    # Like an OS thread, only the faulting thread dies,
+                    # not the host.
+                    thread.stop()
+                    traceback.print_exc()
+        self.threads[:] = [thread for thread in self.threads if thread.running]
 
     def draw(self):
         self.sprites.draw(self.window)
 
+    @staticmethod
+    def _program_cache_path(code_hash: str) -> str:
+        return os.path.join(PROGRAM_CACHE_DIR, f"{code_hash}.pkl")
+
+    def _decode(self):
+        """Decode the bytecode into self.program, a list of (op, arg) pairs,
+        where arg is None for ops without an operand.
+        Byte offsets are mapped to program indices in self.labels, so that
+        jump targets assembled as offsets can still be resolved.
+        Decoded programs are cached on disk by the hash of their bytecode
+        and of the opcode table used to decode it."""
+        code_hash = hashlib.sha256(VMThread._signature)
+        code_hash.update(self.code)
+        path = self._program_cache_path(code_hash.hexdigest())
+        try:
+            with open(path, "rb") as file:
+                self.program, self.labels, warnings = self._read_program_cache(pickle.load(file))
+        except Exception:
+            # Missing, unreadable or malformed; decode from scratch.
+            instructions, labels, warnings = self._decode_bytecode()
+            self._write_program_cache(path, (PROGRAM_CACHE_VERSION, instructions, labels, warnings))
+            self.program, self.labels = self._build_program(instructions), labels
+        for warning in warnings:
+            print(warning)
+
+    @staticmethod
+    def _build_program(instructions):
+        """Turn (opcode, args) pairs into (op, arg) pairs for VMThread.run."""
+        optable = VMThread._optable
+        program = []
+        for opbyte, args in instructions:
+            op = optable[opbyte]
+            if op is None or len(args) != len(op.operands):
+                raise ValueError(f"invalid instruction {opbyte}{args}")
+            program.append((op, args[0] if args else None))
+        return program
+
+    @classmethod
+    def _read_program_cache(cls, entry):
+        """Validate a cache entry, returning the program, labels and warnings."""
+        version, instructions, labels, warnings = entry
+        if version != PROGRAM_CACHE_VERSION:
+            raise ValueError("stale program cache")
+        program = cls._build_program(instructions)
+        if not all(0 <= index <= len(program) for index in labels.values()):
+            raise ValueError("label out of range")
+        return program, labels, [str(warning) for warning in warnings]
+
+    def _decode_bytecode(self):
+        """Walk the bytecode, returning (opcode, args) pairs, the
+        offset-to-index label map and any decoding warnings."""
+        code = self.code
+        optable = VMThread._optable
+        instructions = []
+        labels = dict()
+        warnings = []
+        pc = 0
+        while pc < len(code):
+            labels[pc] = len(instructions)
+            opbyte = code[pc]
+            op = optable[opbyte]
+            if op is None:
+                warnings.append(f"Opcode {opbyte} not found")
+                pc += 1
+                continue
+            args = []
+            for operand in op.operands:
+                if operand == LITINT:
+                    operand_bytes = code[pc+1:pc+5]
+                    if len(operand_bytes) != 4:
+                        raise ValueError(f"truncated integer operand at {pc}")
+                    # Signed, like the assembler packs them; offsets fit in 31 bits.
+                    args.append(int.from_bytes(operand_bytes, "little", signed=True))
+                    pc += 4
+                elif operand == LITSTR:
+                    end = code.index(0, pc + 1)
+                    args.append(bytes(code[pc+1:end]).decode("utf-8"))
+                    pc = end
+            instructions.append((opbyte, tuple(args)))
+            pc += 1
+        labels[pc] = len(instructions)
+        return instructions, labels, warnings
+
+    @staticmethod
+    def _write_program_cache(path: str, entry):
+        """Atomically write a cache entry. Failure only costs a re-decode
+        next time, so it is not fatal."""
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(path), delete=False) as file:
+                pickle.dump(entry, file, pickle.HIGHEST_PROTOCOL)
+            os.replace(file.name, path)
+        except OSError as e:
+            print(f"Couldn't write program cache {path}: {e}")
+
     def _call_fork(self, pc):
-        thread = VMThread(self, pc=pc)
-        thread.start()
-        self.threads.append(thread)
+        self.threads.append(VMThread(self, pc=self.labels[pc]))
 
     def reset(self):
         """Reset state, unload all sprite banks,
@@ -42,50 +176,56 @@ class Runtime:
         self.threads.clear()
 
 
-class VMThread(threading.Thread):
+class VMThread:
+    """An execution thread, scheduled cooperatively by its Runtime."""
 
     def __init__(self, global_state, pc=0):
-        threading.Thread.__init__(self)
         self.global_state = global_state
         self.sprite_bank = global_state.sprite_bank
-        self.code = global_state.code
+        self.free_banks = global_state.free_banks
+        self.program = global_state.program
+        self.labels = global_state.labels
         self.sprites = global_state.sprites
         self.pc = pc
-        self.str_stack = []
-        self.int_stack = []
+        # Fixed-size stacks; isp and ssp index the next free slot.
+        self.str_stack = [None] * STR_STACK_SIZE
+        self.ssp = 0
+        self.int_stack = array('q', bytes(8 * INT_STACK_SIZE))
+        self.isp = 0
         self.call_stack = []
         self.attr_list = dict()
         self.running = True
+        self.wake_time = 0
 
-    def run(self):
-        while self.running:
-            newpc = self.pc
-            op = self.opcodes[self.code[self.pc]]
-            if op is not None:
-                args = []
-                for operand in op.operands:
-                    if operand == LITINT:
-                        newpc += 4
-                        args.append(struct.unpack("I", self.code[newpc-3:newpc+1])[0])
-                    elif operand == LITSTR:
-                        newpc += 1
-                        new_str = bytearray()
-                        # Buffer overrun problem - but I'll let it happen.
-                        while self.code[newpc] != 0x0:
-                            new_str.append(self.code[newpc])
-                            newpc += 1
-                        args.append(new_str.decode("utf-8"))
-                # print(f"{self.pc}: {op.__name__}({args})")
-                self.pc = newpc
-                try:
-                    op.__call__(self, *args)
-                except Exception as e:
-                    print(f"Core dumped! PC: {self.pc}, ints: {self.int_stack}, strs: {self.str_stack}")
-                    self.reset()
-                    raise e
-            else:
-                print("Opcode {0} not found".format(self.code[self.pc]))
-            self.pc += 1
+    def run(self, quantum=QUANTUM):
+        """Execute up to quantum instructions, returning early if the
+        thread stops or goes to sleep."""
+        if self.wake_time:
+            if perf_counter() < self.wake_time:
+                return
+            self.wake_time = 0
+        program = self.program
+        pc = self.pc
+        for _ in range(quantum):
+            if not self.running or self.wake_time:
+                break
+            # Ops that branch read and write self.pc directly.
+            self.pc = pc
+            try:
+                # Running off the end of the program faults here too.
+                op, arg = program[pc]
+                # print(f"{pc}: {op.__name__}({arg})")
+                if arg is None:
+                    op(self)
+                else:
+                    op(self, arg)
+            except Exception as e:
+                print(f"Core dumped! PC: {self.pc}, ints: {self.int_stack[:self.isp].tolist()}, "
+                      f"strs: {self.str_stack[:self.ssp]}")
+                self.reset()
+                raise e
+            pc = self.pc + 1
+        self.pc = pc
 
     def stop(self):
         self.running = False
@@ -99,18 +239,38 @@ class VMThread(threading.Thread):
 
     def loadspr(self):
         """Load a sprite located in a virtual path into a bank."""
-        vpath = self.str_stack.pop()
-        banknum = self.int_stack.pop()
+        if self.ssp < 1:
+            raise IndexError("string stack underflow")
+        if self.isp < 1:
+            raise IndexError("integer stack underflow")
+        self.ssp -= 1
+        vpath = self.str_stack[self.ssp]
+        self.str_stack[self.ssp] = None
+        self.isp -= 1
+        banknum = self.int_stack[self.isp]
         newsprite = SpriteSurface(vpath)
+        oldsprite = self.sprite_bank[banknum]
+        if oldsprite is None:
+            # Banks from openbank are at the front, so this is O(1) for them.
+            self.free_banks.remove(banknum)
+        else:
+            self.sprites.remove(oldsprite)
         self.sprite_bank[banknum] = newsprite
         self.sprites.add(newsprite)
     loadspr.operands = []
 
     def unloadspr(self):
         """Unload the sprite in a bank."""
-        index = self.int_stack.pop()
-        self.sprites.remove(self.sprite_bank[index])
+        if self.isp < 1:
+            raise IndexError("integer stack underflow")
+        self.isp -= 1
+        index = self.int_stack[self.isp]
+        sprite = self.sprite_bank[index]
+        if sprite is None:
+            return
+        self.sprites.remove(sprite)
         self.sprite_bank[index] = None
+        self.free_banks.append(index)
     unloadspr.operands = []
 
     def fork(self, litint_procedure: int):
@@ -120,7 +280,7 @@ class VMThread(threading.Thread):
         """
         # Final check: are we actually supposed to be running?
         if self.running:
-            self.global_state._call_fork()
+            self.global_state._call_fork(litint_procedure)
     fork.operands = [LITINT]
 
     def ret(self):
@@ -131,22 +291,24 @@ class VMThread(threading.Thread):
     def call(self, litint_procedure: int):
         """Call a specified procedure."""
         self.call_stack.append(self.pc)
-        self.pc = litint_procedure - 1
+        self.pc = self.labels[litint_procedure] - 1
     call.operands = [LITINT]
 
     def pushs(self, litstr: str):
         """Push a string register into the string stack."""
-        self.str_stack.append(litstr)
+        self.str_stack[self.ssp] = litstr
+        self.ssp += 1
     pushs.operands = [LITSTR]
 
     def pushi(self, litint: int):
         """Push an integer register into the integer stack."""
-        self.int_stack.append(litint)
+        self.int_stack[self.isp] = litint
+        self.isp += 1
     pushi.operands = [LITINT]
 
     def waitms(self, litint_ms: int):
         """Delay this execution thread by a given number of milliseconds."""
-        sleep(litint_ms * .001)
+        self.wake_time = perf_counter() + litint_ms * .001
     waitms.operands = [LITINT]
     waitms.asm_name = "wait"
 
@@ -171,7 +333,11 @@ class VMThread(threading.Thread):
     def alpha(self):
         """Set the alpha of a sprite.
         Attributes: 'fade' (any int >= 0) """
-        self.sprite_bank[self.int_stack.pop()].alpha = self.int_stack.pop()
+        if self.isp < 2:
+            raise IndexError("integer stack underflow")
+        isp = self.isp - 2
+        self.isp = isp
+        self.sprite_bank[self.int_stack[isp]].alpha = self.int_stack[isp + 1]
     alpha.operands = []
 
     def layer(self):
@@ -183,112 +349,183 @@ class VMThread(threading.Thread):
     def attri(self):
         """Append an attribute/modifier to the next applicable operation
         with an integer value."""
-        self.attr_list[self.str_stack.pop()] = self.int_stack.pop()
+        if self.ssp < 1:
+            raise IndexError("string stack underflow")
+        if self.isp < 1:
+            raise IndexError("integer stack underflow")
+        self.ssp -= 1
+        self.isp -= 1
+        self.attr_list[self.str_stack[self.ssp]] = self.int_stack[self.isp]
+        self.str_stack[self.ssp] = None
     attri.operands = []
 
     def attrs(self):
         """Append an attribute/modifier to the next applicable operation
         with a string value."""
-        self.attr_list[self.str_stack.pop()] = self.str_stack.pop()
+        if self.ssp < 2:
+            raise IndexError("string stack underflow")
+        ssp = self.ssp - 2
+        self.ssp = ssp
+        str_stack = self.str_stack
+        self.attr_list[str_stack[ssp]] = str_stack[ssp + 1]
+        str_stack[ssp] = str_stack[ssp + 1] = None
     attrs.operands = []
 
     def openbank(self):
         """Return the number of an open bank slot."""
-        for index, bank in enumerate(self.sprite_bank):
-            if bank is None:
-                self.int_stack.append(index)
-                return
+        if self.free_banks:
+            self.int_stack[self.isp] = self.free_banks[0]
+            self.isp += 1
     openbank.operands = []
 
     def concat(self):
         """Concatenate two strings."""
-        self.str_stack.append(self.str_stack.pop(-2) + self.str_stack.pop())
+        if self.ssp < 2:
+            raise IndexError("string stack underflow")
+        ssp = self.ssp - 1
+        self.ssp = ssp
+        str_stack = self.str_stack
+        str_stack[ssp - 1] = _concat(str_stack[ssp - 1], str_stack[ssp])
+        str_stack[ssp] = None
     concat.operands = []
 
     def jl(self, litint: int):
         """Jump to procedure if top is less than 0."""
-        if self.int_stack.pop() < 0:
-            self.pc = litint - 1
+        if self.isp < 1:
+            raise IndexError("integer stack underflow")
+        self.isp -= 1
+        if self.int_stack[self.isp] < 0:
+            self.pc = self.labels[litint] - 1
     jl.operands = [LITINT]
 
     def je(self, litint: int):
         """Jump to procedure if top is equal to 0."""
-        if self.int_stack.pop() == 0:
-            self.pc = litint - 1
+        if self.isp < 1:
+            raise IndexError("integer stack underflow")
+        self.isp -= 1
+        if self.int_stack[self.isp] == 0:
+            self.pc = self.labels[litint] - 1
     je.operands = [LITINT]
 
     def jg(self, litint: int):
         """Jump to procedure if top is greater than 0."""
-        if self.int_stack.pop() > 0:
-            self.pc = litint - 1
+        if self.isp < 1:
+            raise IndexError("integer stack underflow")
+        self.isp -= 1
+        if self.int_stack[self.isp] > 0:
+            self.pc = self.labels[litint] - 1
     jg.operands = [LITINT]
 
     def jmp(self, litint: int):
         """Jump to procedure."""
-        self.pc = litint - 1
+        self.pc = self.labels[litint] - 1
     jmp.operands = [LITINT]
 
     def castis(self):
         """Cast an integer into a string."""
-        self.str_stack = str(self.int_stack.pop())
+        if self.isp < 1:
+            raise IndexError("integer stack underflow")
+        self.isp -= 1
+        self.str_stack[self.ssp] = _cast(self.int_stack[self.isp])
+        self.ssp += 1
     castis.operands = []
     castis.asm_name = "cast"
 
     def dbgs(self):
         """Debug print a string."""
-        print(self.str_stack[-1])
+        if self.ssp < 1:
+            raise IndexError("string stack underflow")
+        print(self.str_stack[self.ssp - 1])
     dbgs.operands = []
     dbgs.asm_name = "dbgs"
 
     def dbgi(self):
         """Debug print an integer."""
-        print(self.int_stack[-1])
+        if self.isp < 1:
+            raise IndexError("integer stack underflow")
+        print(self.int_stack[self.isp - 1])
     dbgi.operands = []
     dbgi.asm_name = "dbgi"
 
     def add(self):
-        self.int_stack.append(self.int_stack.pop() + self.int_stack.pop())
+        if self.isp < 2:
+            raise IndexError("integer stack underflow")
+        isp = self.isp - 1
+        self.isp = isp
+        self.int_stack[isp - 1] += self.int_stack[isp]
     add.operands = []
     add.asm_name = "add"
 
     def sub(self):
-        self.int_stack.append(self.int_stack.pop(-2) - self.int_stack.pop())
+        if self.isp < 2:
+            raise IndexError("integer stack underflow")
+        isp = self.isp - 1
+        self.isp = isp
+        self.int_stack[isp - 1] -= self.int_stack[isp]
     sub.operands = []
     sub.asm_name = "sub"
 
     def mul(self):
-        self.int_stack.append(self.int_stack.pop() * self.int_stack.pop())
+        if self.isp < 2:
+            raise IndexError("integer stack underflow")
+        isp = self.isp - 1
+        self.isp = isp
+        self.int_stack[isp - 1] *= self.int_stack[isp]
     mul.operands = []
     mul.asm_name = "mul"
 
     def div(self):
-        self.int_stack.append(int(self.int_stack.pop(-2) / self.int_stack.pop()))
+        if self.isp < 2:
+            raise IndexError("integer stack underflow")
+        isp = self.isp - 1
+        self.isp = isp
+        int_stack = self.int_stack
+        int_stack[isp - 1] = int(int_stack[isp - 1] / int_stack[isp])
     div.operands = []
     div.asm_name = "div"
 
     def dups(self):
         """Duplicate the top of the string stack."""
-        self.str_stack.append(self.str_stack[-1])
+        if self.ssp < 1:
+            raise IndexError("string stack underflow")
+        self.str_stack[self.ssp] = self.str_stack[self.ssp - 1]
+        self.ssp += 1
     dups.operands = []
 
     def dupi(self):
         """Duplicate the top of the integer stack."""
-        self.int_stack.append(self.int_stack[-1])
+        if self.isp < 1:
+            raise IndexError("integer stack underflow")
+        self.int_stack[self.isp] = self.int_stack[self.isp - 1]
+        self.isp += 1
     dupi.operands = []
 
     def setspr(self):
         """Set the specific image of a sprite."""
-        self.sprite_bank[self.int_stack.pop()].anim_name = self.str_stack.pop()
+        if self.ssp < 1:
+            raise IndexError("string stack underflow")
+        if self.isp < 1:
+            raise IndexError("integer stack underflow")
+        self.ssp -= 1
+        self.isp -= 1
+        self.sprite_bank[self.int_stack[self.isp]].anim_name = self.str_stack[self.ssp]
+        self.str_stack[self.ssp] = None
     setspr.operands = []
 
     def swaps(self):
         """Swap the top and second-top stack elements."""
-        self.str_stack.append(self.str_stack.pop(-2))
+        str_stack, ssp = self.str_stack, self.ssp
+        if ssp < 2:
+            raise IndexError("string stack underflow")
+        str_stack[ssp - 2], str_stack[ssp - 1] = str_stack[ssp - 1], str_stack[ssp - 2]
     swaps.operands = []
 
     def swapi(self):
         """Swap the top and second-top stack elements."""
-        self.int_stack.append(self.int_stack.pop(-2))
+        int_stack, isp = self.int_stack, self.isp
+        if isp < 2:
+            raise IndexError("integer stack underflow")
+        int_stack[isp - 2], int_stack[isp - 1] = int_stack[isp - 1], int_stack[isp - 2]
     swapi.operands = []
 
     @staticmethod
@@ -334,3 +571,12 @@ class VMThread(threading.Thread):
         0x2b: swaps,
         0x2c: swapi
     }
+
+    # Direct-indexed dispatch table; unassigned opcodes are None.
+    _optable = tuple(map(opcodes.get, range(256)))
+    # Ops are dispatched with either no operand or exactly one.
+    if any(len(op.operands) > 1 for op in opcodes.values()):
+        raise TypeError("VM ops may take at most one operand")
+    # Identifies the opcode layout in the program cache key.
+    _signature = repr(sorted((opbyte, op.__name__, op.operands)
+                             for opbyte, op in opcodes.items())).encode()